@@ -53,5 +53,23 @@ Ticket = conf.registerPlugin('Ticket')
 # conf.registerGlobalValue(Ticket, 'someConfigVariableName',
 #     registry.Boolean(False, _("""Help for someConfigVariableName.""")))
 
+conf.registerGroup(Ticket, 'shedding')
+conf.registerGlobalValue(Ticket.shedding, 'window',
+    registry.PositiveInteger(60, _("""Determines over how many seconds ticket
+    lookups are counted for load shedding.""")))
+conf.registerGlobalValue(Ticket.shedding, 'perChannel',
+    registry.PositiveInteger(8, _("""Determines how many ticket lookups are
+    done at most for one channel during the window.""")))
+conf.registerGlobalValue(Ticket.shedding, 'overall',
+    registry.PositiveInteger(30, _("""Determines how many ticket lookups are
+    done at most for all channels together during the window.""")))
+conf.registerGlobalValue(Ticket.shedding, 'burst',
+    registry.PositiveInteger(24, _("""Determines how many ticket lookups a
+    channel may ask for during the window before it is considered flooded and
+    gets no lookups at all for a while.""")))
+conf.registerGlobalValue(Ticket.shedding, 'suppress',
+    registry.PositiveInteger(300, _("""Determines for how many seconds a
+    flooded channel gets no ticket lookups.""")))
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
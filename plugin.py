@@ -28,13 +28,16 @@
 
 ###
 
+import supybot.conf as conf
 import supybot.utils as utils
 from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircmsgs as ircmsgs
 import supybot.ircutils as ircutils
 import supybot.callbacks as callbacks
+import supybot.schedule as schedule
 import importlib
+import time
 try:
     from supybot.i18n import PluginInternationalization
     _ = PluginInternationalization('Ticket')
@@ -48,6 +51,16 @@ try:
 except ImportError:
     from . import ticketconfig
 importlib.reload(ticketconfig)
+# ticketconfig reloads tickethelpers whenever it is reloaded itself.
+from . import tickethelpers as h
+
+# The providers and load shedder of the last instance, so that a plugin
+# reload can carry over their state.  The module is reloaded in place, so
+# keep any value left over from before.
+try:
+    _previousState
+except NameError:
+    _previousState = None
 
 
 class Ticket(callbacks.Plugin):
@@ -58,15 +71,138 @@ class Ticket(callbacks.Plugin):
         self._config = ticketconfig.TicketConfig()
 
         self.providers = self._config.providers
+        self._shedder = self._makeShedder()
+        self._profile = None
+        self._profileStart = None
+
+        if _previousState is not None:
+            (providers, shedder) = _previousState
+            h.adoptState(self.providers, providers)
+            self._shedder.adoptState(shedder)
+
+    def _makeShedder(self):
+        return h.LoadShedder(
+            window=self.registryValue('shedding.window'),
+            perChannel=self.registryValue('shedding.perChannel'),
+            overall=self.registryValue('shedding.overall'),
+            burst=self.registryValue('shedding.burst'),
+            suppress=self.registryValue('shedding.suppress'))
+
+    def die(self):
+        global _previousState
+        self._stopProfile()
+        _previousState = (self.providers, self._shedder)
+        self.__parent.die()
+
+    def reloadconfig(self, irc, msg, args):
+        """takes no arguments
+
+        Reloads the ticket provider configuration and the load shedding
+        settings.  Providers whose definition did not change keep their
+        state.
+        """
+        self._finishProfile()
+        importlib.reload(ticketconfig)
+        config = ticketconfig.TicketConfig()
+        (kept, rebuilt) = h.adoptState(config.providers, self.providers)
+        self._config = config
+        self.providers = config.providers
+        shedder = self._makeShedder()
+        shedder.adoptState(self._shedder)
+        self._shedder = shedder
+        irc.reply(utils.str.format('Kept %n; rebuilt: %L.',
+            (len(kept), 'provider'), rebuilt or ['none']))
+    reloadconfig = wrap(reloadconfig, ['owner'])
+
+    def shedding(self, irc, msg, args):
+        """takes no arguments
+
+        Reports how many lookups were shed because of floods, per channel
+        and provider, and which channels are currently suppressed.
+        """
+        shedder = self._shedder
+        counts = ['%s/%s: %d' % (channel, name, n)
+                  for ((channel, name), n) in shedder.shed.most_common()]
+        irc.reply(utils.str.format('Shed %n (%L); suppressed: %L.',
+            (sum(shedder.shed.values()), 'lookup'),
+            counts or ['none'],
+            sorted(shedder.suppressed) or ['none']))
+    shedding = wrap(shedding, ['owner'])
+
+    def profile(self, irc, msg, args, optlist):
+        """[--messages <n>] [--seconds <t>]
+
+        Profiles the ticket providers for the next <n> channel messages
+        (default 100) or <t> seconds, whichever ends first.  Then writes the
+        profile to the data directory and messages you the hottest
+        functions of each provider.
+        """
+        if self._profile is not None:
+            irc.error('A profile is already running.', Raise=True)
+        opts = dict(optlist)
+        messages = opts.get('messages')
+        seconds = opts.get('seconds')
+        if messages is None and seconds is None:
+            messages = 100
+
+        self._profile = h.ProfileSession(self.providers.values(), messages, seconds)
+        self._profileTarget = (irc.getRealIrc(), msg.nick)
+        # doPrivmsg still sees the message asking for the profile, skip it.
+        self._profileStart = msg
+        if seconds is not None:
+            schedule.addEvent(self._finishProfile, time.time() + seconds, 'TicketProfile')
+        irc.replySuccess()
+    profile = wrap(profile, ['owner', getopts({'messages': 'positiveInt', 'seconds': 'positiveInt'})])
+
+    def _stopProfile(self, path=None):
+        session, self._profile = self._profile, None
+        if session is None:
+            return None
+        try:
+            schedule.removeEvent('TicketProfile')
+        except KeyError:
+            pass
+        session.stop(path)
+        return session
+
+    def _finishProfile(self):
+        path = conf.supybot.directories.data.dirize('Ticket-profile-%d.pstats' % time.time())
+        session = self._stopProfile(path)
+        if session is None:
+            return
+
+        (irc, nick) = self._profileTarget
+        if session.written:
+            lines = ['Profiled %d messages, written to %s' % (session.messages, path)]
+            lines += session.summary()
+        else:
+            lines = ['Profiled %d messages, no provider did any work.' % (session.messages,)]
+        for line in lines:
+            irc.queueMsg(ircmsgs.privmsg(nick, line))
 
     def doPrivmsg(self, irc, msg):
         if irc.isChannel(msg.args[0]):
-            (tgt, payload) = msg.args
-            for p in self.providers:
-                for line in self.providers[p].doPrivmsg(tgt, payload):
-                    assert isinstance(line, str)
-                    irc.queueMsg(ircmsgs.notice(tgt, line))
-                    irc.noReply()
+            if self._profile is None or msg is self._profileStart:
+                self._announce(irc, msg)
+            else:
+                self._profile.call(self._announce, irc, msg)
+                self._profile.countMessage()
+                if self._profile.isDone(): self._finishProfile()
+
+    def _announce(self, irc, msg):
+        """Look up and announce the tickets mentioned in a channel message."""
+        (tgt, payload) = msg.args
+        pending = h.collectPending(self.providers.values(), tgt, payload)
+        for (provider, m) in self._shedder.admit(tgt, pending):
+            try:
+                line = provider.lookup(tgt, m)
+            except Exception:
+                self.log.exception('[%s][%s] failed to look up %s', provider.name, tgt, m)
+                continue
+            if line is None: continue
+            assert isinstance(line, str)
+            irc.queueMsg(ircmsgs.notice(tgt, line))
+            irc.noReply()
 
 
 Class = Ticket
@@ -30,8 +30,351 @@
 
 from supybot.test import *
 
+import email.message
+import glob
+import gzip
+import io
+import os
+import re
+import subprocess
+import tempfile
+import urllib.error
+import zlib
+
+from . import ticketconfig
+from . import tickethelpers as h
+
 class TicketTestCase(PluginTestCase):
     plugins = ('Ticket',)
 
+    def testReloadconfig(self):
+        self.assertRegexp('reloadconfig', 'rebuilt: none')
+
+    def testShedding(self):
+        self.assertRegexp('shedding', 'Shed 0 lookups')
+
+    def testProfileRunning(self):
+        self.assertNotError('profile --messages 1')
+        self.assertError('profile')
+
+
+class AdoptStateTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.old = ticketconfig.TicketConfig().providers
+        self.new = ticketconfig.TicketConfig().providers
+
+    def testUnchanged(self):
+        self.old['bugs.debian.org'].lastSent[('#debian-devel', '1234')] = 42
+        self.old['proposal.torproject.org'].data = '300  Some proposal [OPEN]'
+        self.old['proposal.torproject.org'].expire = 4242
+        self.assertEqual(h.adoptState(self.new, self.old),
+                         (list(self.new), []))
+        self.assertEqual(self.new['bugs.debian.org'].lastSent, { ('#debian-devel', '1234'): 42 })
+        self.assertEqual(self.new['proposal.torproject.org'].data, '300  Some proposal [OPEN]')
+        self.assertEqual(self.new['proposal.torproject.org'].expire, 4242)
+
+    def testChanged(self):
+        self.old['bugs.debian.org'].lastSent[('#debian-devel', '1234')] = 42
+        self.new['bugs.debian.org'].prefix = 'Deb'
+        self.new['xkcd.com'].re = r'(?<!\w)xkcd:([0-9]+)'
+        self.new['munin-monitoring.org'].fixup = h.ReGroupFixup('(.*) - GitHub$')
+        self.new['rt.debian.org'].addChannel('#debian-admin', regex=r'(?<!\w)RT#([0-9]+)')
+        (kept, rebuilt) = h.adoptState(self.new, self.old)
+        self.assertEqual(sorted(rebuilt), ['bugs.debian.org', 'munin-monitoring.org',
+                                           'rt.debian.org', 'xkcd.com'])
+        self.assertEqual(self.new['bugs.debian.org'].lastSent, {})
+
+    def testClosureCountsAsChanged(self):
+        def fixup(pattern):
+            return lambda i, x: re.sub(pattern, '', x)
+        self.old['xkcd.com'].fixup = fixup(' - xkcd$')
+        self.new['xkcd.com'].fixup = fixup(' - xkcd$')
+        (kept, rebuilt) = h.adoptState(self.new, self.old)
+        self.assertEqual(rebuilt, ['xkcd.com'])
+
+
+class LoadShedderTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.low = h.BaseProvider('low', priority=-1)
+        self.normal = h.BaseProvider('normal')
+
+    def _pending(self, n, provider=None):
+        return [(provider or self.normal, str(1000 + i)) for i in range(n)]
+
+    def testPerChannelBudget(self):
+        shedder = h.LoadShedder(perChannel=4)
+        self.assertEqual(len(shedder.admit('#a', self._pending(3))), 3)
+        self.assertEqual(len(shedder.admit('#a', self._pending(3))), 1)
+        self.assertEqual(len(shedder.admit('#b', self._pending(3))), 3)
+        self.assertEqual(shedder.shed[('#a', 'normal')], 2)
+        timeFastForward(shedder.window + 1)
+        self.assertEqual(len(shedder.admit('#a', self._pending(3))), 3)
+
+    def testOverallBudget(self):
+        shedder = h.LoadShedder(perChannel=4, overall=6)
+        self.assertEqual(len(shedder.admit('#a', self._pending(4))), 4)
+        self.assertEqual(len(shedder.admit('#b', self._pending(4))), 2)
+
+    def testLowestPriorityShedFirst(self):
+        shedder = h.LoadShedder(perChannel=2)
+        pending = [(self.low, '1'), (self.normal, '2'), (self.low, '3'), (self.normal, '4')]
+        self.assertEqual(shedder.admit('#a', pending), [(self.normal, '2'), (self.normal, '4')])
+        self.assertEqual(shedder.shed[('#a', 'low')], 2)
+
+    def testConversationIsNotAFlood(self):
+        shedder = h.LoadShedder(perChannel=8, burst=24)
+        for _ in range(3):
+            shedder.admit('#debian-devel', self._pending(3))
+        self.assertNotIn('#debian-devel', shedder.suppressed)
+
+    def testFlood(self):
+        shedder = h.LoadShedder(perChannel=8, burst=24)
+        for _ in range(9):
+            shedder.admit('#debian-devel', self._pending(3))
+        self.assertIn('#debian-devel', shedder.suppressed)
+        self.assertEqual(shedder.admit('#debian-devel', self._pending(1)), [])
+        self.assertEqual(len(shedder.admit('#tor', self._pending(1))), 1)
+        timeFastForward(shedder.suppress + 1)
+        self.assertEqual(len(shedder.admit('#debian-devel', self._pending(1))), 1)
+
+class CollectPendingTestCase(SupyTestCase):
+    def testBrokenProvider(self):
+        broken = h.BaseProvider('broken', default_re=r'(?<!\w)(?i)broken#([0-9]+)')
+        debian = h.BaseProvider('debian', prefix='Debian')
+        debian.addChannel('#debian-*', default=True)
+        self.assertEqual([(p.name, m) for (p, m) in h.collectPending([broken, debian], '#debian-devel', '#1234')],
+                         [('debian', '1234')])
+
+
+class CollectPendingIdentityTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.trac = h.BaseProvider('trac', prefix='tractpo', identity='tor-legacy',
+            default_re=r'(?<!\w)(?:tractpo#|https://trac.example/ticket/)([0-9]{4,})(?:(?=\W)|$)')
+        self.legacy = h.BaseProvider('legacy', prefix='tor', identity='tor-legacy', precedence=1,
+            default_re=r'(?<!\w)(?:[tT]or#|https://trac.example/ticket/)([0-9]{4,})(?:(?=\W)|$)')
+        self.debian = h.BaseProvider('debian', prefix='Debian')
+        for channel in ('#debian-*', '#deb*'):
+            self.debian.addChannel(channel, default=True)
+        self.providers = [self.trac, self.legacy, self.debian]
+
+    def _collect(self, tgt, msg):
+        return [(p.name, m) for (p, m) in h.collectPending(self.providers, tgt, msg)]
+
+    def testAliases(self):
+        self.assertEqual(self._collect('#tor', 'https://trac.example/ticket/1234 and tor#1234'),
+                         [('legacy', '1234')])
+        self.assertEqual(self._collect('#tor', 'tractpo#1234'), [('trac', '1234')])
+
+    def testOrderOfMention(self):
+        self.assertEqual(self._collect('#debian-devel', '#5678 then tractpo#1234 then #5679'),
+                         [('debian', '5678'), ('trac', '1234'), ('debian', '5679')])
+
+    def testOverlappingChannels(self):
+        self.assertEqual(self._collect('#debian-devel', '#1234 #5678 #1234'),
+                         [('debian', '1234'), ('debian', '5678')])
+
+    def testRateLimitedPreferredProvider(self):
+        self.legacy.lastSent[('#tor', '1234')] = time.time()
+        self.assertEqual(self._collect('#tor', 'https://trac.example/ticket/1234'), [])
+
+    def testRateLimitedByAlias(self):
+        self.trac.lastSent[('#tor', '1234')] = time.time()
+        self.assertEqual(self._collect('#tor', 'tor#1234'), [])
+
+
+def _message(**kwargs):
+    headers = email.message.Message()
+    for (k, v) in kwargs.items():
+        headers[k.replace('_', '-')] = v
+    return headers
+
+class FakeTransport(h.Transport):
+    """Serves canned documents and command outputs, and fails for the rest."""
+    def __init__(self, documents=None, outputs=None):
+        self.documents = documents or {}
+        self.outputs = outputs or {}
+
+    def fetch(self, url, maxBytes=None):
+        if url not in self.documents:
+            if url.startswith('http://unreachable'):
+                raise urllib.error.URLError('Name or service not known')
+            raise urllib.error.HTTPError(url, 404, 'Not Found', _message(), io.BytesIO(b'no such ticket'))
+        headers = _message(Content_Type='text/html; charset=utf-8')
+        return h.Response(url, 200, headers, self.documents[url], 0.05)
+
+    def run(self, argv, env):
+        if argv[3] not in self.outputs:
+            raise subprocess.CalledProcessError(1, argv, b'No matching results.')
+        return self.outputs[argv[3]]
+
+class ReplayTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive = os.path.join(self.tmp.name, 'fixtures.json')
+        self.fake = FakeTransport(
+            { 'http://bts/issue1': b'<html><head><title>Issue 1: It broke - GRML issue tracker</title></head></html>' },
+            { '42': b'42: A request\n' })
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        SupyTestCase.tearDown(self)
+
+    def _exercise(self, transport):
+        """Returns what transport gives for a set of requests."""
+        res = []
+        res.append(transport.fetch('http://bts/issue1').text())
+        try:
+            transport.fetch('http://bts/issue2')
+        except urllib.error.HTTPError as e:
+            res.append((e.code, e.read()))
+        try:
+            transport.fetch('http://unreachable/issue3')
+        except urllib.error.URLError as e:
+            res.append(('URLError', str(e.reason)))
+        res.append(transport.run(['rt', 'ls', '-i', '42', '-s'], {}))
+        try:
+            transport.run(['rt', 'ls', '-i', '43', '-s'], {})
+        except subprocess.CalledProcessError as e:
+            res.append((e.returncode, e.output))
+        return res
+
+    def testRoundTrip(self):
+        recorded = self._exercise(h.RecordingTransport(self.archive, self.fake))
+        self.assertEqual(recorded[1], (404, b'no such ticket'))
+        self.assertEqual(self._exercise(h.ReplayTransport(self.archive)), recorded)
+
+    def testMissing(self):
+        h.RecordingTransport(self.archive, self.fake).fetch('http://bts/issue1')
+        self.assertRaises(KeyError, h.ReplayTransport(self.archive).fetch, 'http://bts/issue4')
+
+    def testProviders(self):
+        grml = h.TicketHtmlTitleProvider('bts', 'http://bts/issue',
+            fixup=h.ReGroupFixup('Issue [0-9]+: (.*) - GRML issue tracker$'), prefix='GRML')
+        rt = h.TicketRTProvider('rt', '~/.rtrc', fixup=h.ReGroupFixup('[0-9]+: *(.*)$'), prefix='RT')
+
+        h.useTransport([grml, rt], h.RecordingTransport(self.archive, self.fake))
+        self.assertEqual(grml['1'], 'GRML#1: It broke')
+        self.assertEqual(rt['42'], 'RT#42: A request')
+        self.assertRaises(IndexError, grml.__getitem__, '2')
+
+        h.useTransport([grml, rt], h.ReplayTransport(self.archive))
+        self.assertEqual(grml['1'], 'GRML#1: It broke')
+        self.assertEqual(rt['42'], 'RT#42: A request')
+        self.assertRaises(IndexError, grml.__getitem__, '2')
+
+class TicketAnnounceTestCase(ChannelPluginTestCase):
+    plugins = ('Ticket',)
+
+    def setUp(self):
+        ChannelPluginTestCase.setUp(self)
+        self.tmp = tempfile.TemporaryDirectory()
+        archive = os.path.join(self.tmp.name, 'fixtures.json')
+        recorder = h.RecordingTransport(archive, FakeTransport(
+            { 'https://m.xkcd.com/1235': b'<html><head><title>xkcd: Replayed</title></head></html>' }))
+        recorder.fetch('https://m.xkcd.com/1235')
+        h.useTransport(self.irc.getCallback('Ticket').providers.values(), h.ReplayTransport(archive))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        ChannelPluginTestCase.tearDown(self)
+
+    def testAnnounce(self):
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'see xkcd#1235', prefix=self.prefix))
+        m = self.irc.takeMsg()
+        self.assertIsNotNone(m)
+        self.assertEqual(m.command, 'NOTICE')
+        self.assertEqual(m.args, (self.channel, 'xkcd#1235: Replayed - https://m.xkcd.com/1235/'))
+
+
+class TransportReadTestCase(SupyTestCase):
+    body = ('<html><head><title>Tïtle</title></head>' + 'x' * 100000 + '</html>').encode('utf-8')
+
+    def _read(self, data, encoding=None, maxBytes=None):
+        headers = _message(Content_Type='text/html; charset=utf-8', Content_Length=str(len(data)))
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        (body, truncated) = h.Transport()._read(io.BytesIO(data), headers, maxBytes)
+        self.assertIsNone(headers['Content-Encoding'])
+        return (body, truncated)
+
+    def testEncodings(self):
+        for (encoding, data) in ((None, self.body),
+                                 ('gzip', gzip.compress(self.body)),
+                                 ('deflate', zlib.compress(self.body)),
+                                 ('deflate', zlib.compress(self.body)[2:-4])):
+            self.assertEqual(self._read(data, encoding), (self.body, False), encoding)
+
+    def testTruncation(self):
+        for (encoding, data) in ((None, self.body),
+                                 ('gzip', gzip.compress(self.body)),
+                                 ('deflate', zlib.compress(self.body))):
+            (body, truncated) = self._read(data, encoding, 32)
+            self.assertEqual(body, self.body[:32], encoding)
+            self.assertTrue(truncated)
+
+    def testTruncatedCharset(self):
+        # cut in the middle of the two byte i with diaeresis
+        (body, truncated) = self._read(self.body, maxBytes=self.body.index(b'\xc3\xaf') + 1)
+        response = h.Response('http://x/', 200, _message(Content_Type='text/html; charset=utf-8'), body, 0, truncated)
+        self.assertEqual(response.text(), '<html><head><title>T')
+
+    def testTruncatedBadBytes(self):
+        # only the end of a truncated body may be cut off, bad bytes elsewhere still fail
+        body = b'<title>\xff</title>' + self.body
+        response = h.Response('http://x/', 200, _message(Content_Type='text/html; charset=utf-8'), body[:40], 0, True)
+        self.assertRaises(UnicodeDecodeError, response.text)
+
+    def testReplayTruncation(self):
+        archive = os.path.join(tempfile.mkdtemp(), 'fixtures.json')
+        h.RecordingTransport(archive, FakeTransport({ 'http://bts/issue1': self.body })).fetch('http://bts/issue1')
+        response = h.ReplayTransport(archive).fetch('http://bts/issue1', 10)
+        self.assertEqual(response.body, self.body[:10])
+        self.assertTrue(response.truncated)
+        os.remove(archive)
+        os.rmdir(os.path.dirname(archive))
+
+
+class TicketProfileTestCase(ChannelPluginTestCase):
+    plugins = ('Ticket',)
+
+    def _profiles(self):
+        return set(glob.glob(conf.supybot.directories.data.dirize('Ticket-profile-*.pstats')))
+
+    def testProfile(self):
+        cb = self.irc.getCallback('Ticket')
+        h.useTransport(cb.providers.values(), FakeTransport(
+            { 'https://m.xkcd.com/1236': b'<html><head><title>xkcd: Profiled</title></head></html>' }))
+        before = self._profiles()
+        self.assertNotError('profile --messages 1')
+        self.assertIsNotNone(cb._profile)
+
+        self.irc.feedMsg(ircmsgs.privmsg(self.channel, 'see xkcd#1236', prefix=self.prefix))
+        msgs = []
+        m = self.irc.takeMsg()
+        while m is not None:
+            msgs.append(m)
+            m = self.irc.takeMsg()
+
+        self.assertIsNone(cb._profile)
+        self.assertIn(('NOTICE', (self.channel, 'xkcd#1236: Profiled - https://m.xkcd.com/1236/')),
+                      [(m.command, m.args) for m in msgs])
+        summary = [m.args[1] for m in msgs if m.command == 'PRIVMSG' and m.args[0] == self.nick]
+        self.assertRegex(summary[0], '^Profiled 1 messages, written to ')
+        self.assertTrue(any(line.startswith('Ticket.doPrivmsg: ') for line in summary[1:]))
+        self.assertTrue(any(line.startswith('xkcd.com: ') and 'in 1 lookups' in line for line in summary[1:]))
+        self.assertLessEqual(len(summary), 6)
+
+        written = self._profiles() - before
+        self.assertEqual(len(written), 1)
+        for path in written:
+            os.remove(path)
+        for provider in cb.providers.values():
+            self.assertNotIn('findMatches', provider.__dict__)
+            self.assertNotIn('lookup', provider.__dict__)
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
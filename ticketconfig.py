@@ -41,7 +41,8 @@ class TicketConfig:
             prefix='tractpo',
             postfix=' - https://bugs.torproject.org/%s',
             default_re=r'(?<!\w)(?:tractpo#|https://trac.torproject.org/projects/tor/ticket/)([0-9]{4,})(?:(?=\W)|$)',
-            status_finder = h.TracStatusExtractor
+            status_finder = h.TracStatusExtractor,
+            identity='tor-legacy',
             ))
         p.append( h.TorProposalProvider( 'proposal.torproject.org',
             fixup=lambda i, x: "Prop#%s: %s" % (x, i) ))
@@ -64,6 +65,8 @@ class TicketConfig:
             default_re=r'(?<!\w)(?:[tT]or#|https://trac.torproject.org/projects/tor/ticket/)([0-9]{4,})(?:(?=\W)|$)',
             postfix=' - https://bugs.torproject.org/%s',
             status_finder = h.GitLabStatusExtractor,
+            identity='tor-legacy',
+            precedence=1,
             ))
         p.append( h.TicketHtmlTitleProvider( 'bugs.debian.org',
             'http://bugs.debian.org/cgi-bin/bugreport.cgi?bug=',
@@ -111,7 +114,7 @@ class TicketConfig:
             fixup=h.ReGroupFixup('xkcd: (.*)'),
             prefix='xkcd',
             postfix=' - https://m.xkcd.com/%s/',
-            default_re=r'(?<!\w)(?i)xkcd#?([0-9]{2,})(?:(?=\W)|$)',
+            default_re=r'(?i)(?<!\w)xkcd#?([0-9]{2,})(?:(?=\W)|$)',
             ))
 
         self.providers = {}
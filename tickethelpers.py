@@ -29,21 +29,333 @@
 ###
 
 from bs4 import BeautifulSoup
+import base64
+import codecs
+import collections
+import cProfile
+import email.message
+import inspect
+import io
+import json
 import os
+import pstats
 import re
 import subprocess
 import time
 import urllib.request, urllib.error, urllib.parse
+import zlib
 import fnmatch
 import supybot.log as log
 
+class Response(object):
+    """A response to an HTTP request made through a transport."""
+
+    def __init__(self, url, status, headers, body, elapsed, truncated=False):
+        """
+        :param headers An email.message.Message (like http.client.HTTPMessage).
+        :param body The body as bytes, after any content-encoding was undone.
+        :param elapsed How many seconds the request took.
+        :param truncated Whether body was cut off at the size limit.
+        """
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.elapsed = elapsed
+        self.truncated = truncated
+
+    def text(self):
+        """Return the body decoded with the charset given in the headers,
+           or the raw bytes if no charset was given (leaving detection
+           to the parser)."""
+        charset = self.headers.get_content_charset()
+        if charset:
+            if self.truncated:
+                # Drop a character cut off at the end, but nothing else.
+                return codecs.getincrementaldecoder(charset)().decode(self.body, final=False)
+            return self.body.decode(charset)
+        return self.body
+
+class Transport(object):
+    """Fetches documents and runs commands for providers, live.
+
+    Documents are requested compressed and decompressed while they are
+    read, and reading stops once the size limit is reached."""
+    chunkSize = 16 * 1024
+
+    def _read(self, response, headers, maxBytes):
+        """Read response, undoing its content-encoding, up to maxBytes of
+           decoded content.  Returns the body and whether it was truncated.
+
+           headers is updated to describe the decoded body."""
+        encoding = headers.get('Content-Encoding', 'identity').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS)
+        else:
+            decompressor = None
+
+        chunks = []
+        size = 0
+        truncated = False
+        first = True
+        while True:
+            data = response.read(self.chunkSize)
+            if not data:
+                if decompressor is not None: chunks.append(decompressor.flush())
+                break
+            if decompressor is not None:
+                # Never decompress more than we are going to keep.
+                limit = maxBytes - size + 1 if maxBytes is not None else 0
+                try:
+                    data = decompressor.decompress(data, limit)
+                except zlib.error:
+                    # Some servers send raw deflate streams without the zlib header.
+                    if encoding != 'deflate' or not first: raise
+                    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+                    data = decompressor.decompress(data, limit)
+            first = False
+            chunks.append(data)
+            size += len(data)
+            if maxBytes is not None and size > maxBytes:
+                truncated = True
+                break
+        response.close()
+
+        body = b''.join(chunks)
+        if maxBytes is not None and len(body) > maxBytes:
+            body = body[:maxBytes]
+            truncated = True
+        if decompressor is not None:
+            del headers['Content-Encoding']
+            del headers['Content-Length']
+        return (body, truncated)
+
+    def fetch(self, url, maxBytes=None):
+        """Get url and return a Response.
+
+        :param maxBytes Keep at most this many bytes of the (decompressed)
+                        body.  None means no limit.
+
+        Raises urllib.error.HTTPError for error responses and
+        urllib.error.URLError if the server cannot be reached."""
+        start = time.time()
+        request = urllib.request.Request(url, headers={ 'Accept-Encoding': 'gzip, deflate' })
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            body, _ = self._read(e, e.headers, maxBytes)
+            raise urllib.error.HTTPError(url, e.code, e.reason, e.headers, io.BytesIO(body))
+        headers = response.info()
+        body, truncated = self._read(response, headers, maxBytes)
+        return Response(url, response.status, headers, body, time.time() - start, truncated)
+
+    def run(self, argv, env):
+        """Run the command argv with environment env and return its output.
+
+        Raises subprocess.CalledProcessError if it fails."""
+        return subprocess.check_output(argv, env=env)
+
+def useTransport(providers, transport):
+    """Make providers (for instance those of a TicketConfig) use transport,
+       say a RecordingTransport or ReplayTransport, instead of fetching live."""
+    for provider in providers:
+        provider.transport = transport
+
+def _headers(pairs):
+    headers = email.message.Message()
+    for (k, v) in pairs:
+        headers[k] = v
+    return headers
+
+class RecordingTransport(Transport):
+    """A transport that passes requests on to another transport and saves
+       requests and responses, including errors and timing, to a fixture
+       archive that ReplayTransport can serve them from later.
+
+       Errors include HTTP error responses, failing commands, and network
+       or OS errors such as unreachable servers and timeouts."""
+
+    def __init__(self, archive, inner=None):
+        """
+        :param archive Path of the archive (a JSON file) to write.  Records
+                       already in it are kept.
+        :param inner The transport to pass requests to.  Defaults to a
+                     live Transport.
+        """
+        self.archive = archive
+        self.inner = inner if inner is not None else Transport()
+        self.records = ReplayTransport.load(archive) if os.path.exists(archive) else {}
+
+    def _save(self, key, record):
+        self.records[key] = record
+        tmp = self.archive + '.new'
+        with open(tmp, 'w') as f:
+            json.dump(list(self.records.values()), f, indent=1)
+        os.replace(tmp, self.archive)
+
+    def fetch(self, url, maxBytes=None):
+        start = time.time()
+        try:
+            response = self.inner.fetch(url, maxBytes)
+        except urllib.error.HTTPError as e:
+            body = e.read()
+            self._save(('http', url), { 'kind': 'http', 'url': url, 'status': e.code, 'reason': e.reason,
+                'headers': list(e.headers.items()), 'body': base64.b64encode(body).decode('ascii'),
+                'elapsed': time.time() - start })
+            # reading used up the body, so hand on a fresh error
+            raise urllib.error.HTTPError(url, e.code, e.reason, e.headers, io.BytesIO(body))
+        except OSError as e:
+            reason = e.reason if isinstance(e, urllib.error.URLError) else e
+            self._save(('http', url), { 'kind': 'http', 'url': url, 'error': str(reason),
+                'elapsed': time.time() - start })
+            raise
+        self._save(('http', url), { 'kind': 'http', 'url': url, 'status': response.status,
+            'headers': list(response.headers.items()), 'body': base64.b64encode(response.body).decode('ascii'),
+            'elapsed': response.elapsed, 'truncated': response.truncated })
+        return response
+
+    def run(self, argv, env):
+        start = time.time()
+        try:
+            output = self.inner.run(argv, env)
+            returncode = 0
+        except subprocess.CalledProcessError as e:
+            output, returncode = e.output or b'', e.returncode
+        except OSError as e:
+            self._save(('command', tuple(argv)), { 'kind': 'command', 'argv': list(argv),
+                'error': str(e), 'elapsed': time.time() - start })
+            raise
+        self._save(('command', tuple(argv)), { 'kind': 'command', 'argv': list(argv),
+            'returncode': returncode, 'output': base64.b64encode(output).decode('ascii'),
+            'elapsed': time.time() - start })
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, argv, output)
+        return output
+
+class ReplayTransport(Transport):
+    """A transport that serves requests from an archive written by
+       RecordingTransport, without touching the network.
+
+       Requests that are not in the archive raise KeyError."""
+
+    def __init__(self, archive, latency=False):
+        """
+        :param archive Path of the archive to serve from.
+        :param latency If set, take as long to answer as the recorded request did.
+        """
+        self.records = self.load(archive)
+        self.latency = latency
+
+    @staticmethod
+    def load(archive):
+        """Read an archive into a dict of records keyed by request."""
+        with open(archive) as f:
+            records = json.load(f)
+        res = {}
+        for r in records:
+            if r['kind'] == 'http':
+                res[('http', r['url'])] = r
+            else:
+                res[('command', tuple(r['argv']))] = r
+        return res
+
+    def _lookup(self, key):
+        try:
+            record = self.records[key]
+        except KeyError:
+            raise KeyError("%s not in replay archive" % (key,))
+        if self.latency: time.sleep(record['elapsed'])
+        return record
+
+    def fetch(self, url, maxBytes=None):
+        r = self._lookup(('http', url))
+        if 'error' in r:
+            raise urllib.error.URLError(r['error'])
+        headers = _headers(r['headers'])
+        body = base64.b64decode(r['body'])
+        truncated = r.get('truncated', False)
+        if maxBytes is not None and len(body) > maxBytes:
+            body = body[:maxBytes]
+            truncated = True
+        if r['status'] >= 400:
+            raise urllib.error.HTTPError(url, r['status'], r.get('reason', 'replayed error'), headers, io.BytesIO(body))
+        return Response(url, r['status'], headers, body, r['elapsed'], truncated)
+
+    def run(self, argv, env):
+        r = self._lookup(('command', tuple(argv)))
+        if 'error' in r:
+            raise OSError(r['error'])
+        output = base64.b64decode(r['output'])
+        if r['returncode'] != 0:
+            raise subprocess.CalledProcessError(r['returncode'], argv, output)
+        return output
+
+class _Incomparable(Exception):
+    """Raised by _comparable() for values it cannot compare reliably."""
+
+_simpleTypes = (str, bytes, int, float, complex, bool, type(None))
+
+def _comparable(value):
+    """Turns a provider config attribute into something that compares equal
+       to the same attribute of a provider constructed from an unchanged
+       definition, even after the modules defining it have been reloaded.
+
+       Handles plain values, tuples and dicts of them, functions and lambdas
+       (by their code), and objects with a definition() method, like
+       ReGroupFixup.  Anything else, including functions with a closure,
+       raises _Incomparable."""
+    if isinstance(value, _simpleTypes):
+        return value
+    if isinstance(value, tuple):
+        return tuple(_comparable(v) for v in value)
+    if isinstance(value, dict):
+        return ('dict', tuple((_comparable(k), _comparable(v))
+                              for (k, v) in sorted(value.items(), key=lambda kv: repr(kv[0]))))
+    if isinstance(value, frozenset):
+        return frozenset(_comparable(v) for v in value)
+    if inspect.iscode(value):
+        return ('code', value.co_code, _comparable(value.co_consts), value.co_names)
+    if inspect.isfunction(value):
+        if value.__closure__ or value.__kwdefaults__:
+            raise _Incomparable(value)
+        return ('function', value.__qualname__, _comparable(value.__code__),
+                _comparable(value.__defaults__))
+    if not inspect.isclass(value) and callable(getattr(value, 'definition', None)):
+        return ('object', type(value).__qualname__, _comparable(value.definition()))
+    raise _Incomparable(value)
+
+def _findall(regex, msg):
+    """Like re.findall(), but returns (position, match) tuples."""
+    res = []
+    for m in re.finditer(regex, msg):
+        groups = m.groups('')
+        if len(groups) == 0: match = m.group(0)
+        elif len(groups) == 1: match = groups[0]
+        else: match = groups
+        res.append((m.start(), match))
+    return res
+
 class BaseProvider(object):
     """A base for most ticket information providers."""
     minRepeat = 1800
     defaultRE = '(?<!\w)#([0-9]{4,})(?:(?=\W)|$)'
     debugChannels = ['#*-test']
-
-    def __init__(self, name, fixup=None, prefix=None, default_re=None, postfix=None, status_finder=None):
+    # Attributes that hold runtime state rather than configuration.  They
+    # are carried over by adoptState() when the config is reloaded.
+    stateAttributes = ('lastSent',)
+    # Attributes that make up how a provider is configured.  adoptState()
+    # compares them to decide whether a provider changed.
+    configAttributes = ('re', 'channels', 'prefix', 'postfix', 'fixup', 'status_finder',
+                        'priority', 'precedence', 'identity', 'maxResponseSize')
+    # How documents are fetched and commands run.  useTransport() can set a
+    # RecordingTransport or ReplayTransport on providers instead.
+    transport = Transport()
+    # How much of a fetched document to read at most, in bytes.
+    maxResponseSize = 1024 * 1024
+
+    def __init__(self, name, fixup=None, prefix=None, default_re=None, postfix=None, status_finder=None, priority=0, precedence=0, identity=None, max_response_size=None):
         """Constructs a base base information provider.
 
         Child classes are then expected to implement _gettitle().
@@ -67,12 +379,29 @@ class BaseProvider(object):
                           the ticketnumber.  If it has more than one group,
                           then ticketnumbers are tuples, and the gettitle() and
                           fixup need to handle this in the derived class.
+        :param priority When lookups need to be shed during a flood, those of
+                        providers with a lower priority are dropped first.
+        :param precedence If several providers with the same identity match
+                          the same ticket, the one with the highest
+                          precedence looks it up.
+        :param identity The namespace of the tickets of this provider.  Give
+                        providers that are aliases for the same tickets (for
+                        instance an old and a new frontend to the same
+                        tracker) the same identity.  Defaults to name.
+        :param max_response_size Read at most this many bytes of the documents
+                                 fetched for this provider, instead of
+                                 maxResponseSize.
         """
         self.name = name
         self.fixup = fixup
         self.prefix = prefix
         self.postfix = postfix
         self.status_finder = status_finder
+        self.priority = priority
+        self.precedence = precedence
+        self.identity = identity if identity is not None else name
+        if max_response_size is not None:
+            self.maxResponseSize = max_response_size
         if default_re is None and self.prefix is not None:
             self.re = r'(?i)(?<!\w)'+self.prefix+r'#([0-9]{2,})(?:(?=\W)|$)'
         else:
@@ -132,10 +461,11 @@ class BaseProvider(object):
         return title
 
     def matches(self, msg):
-        """Return all matches (from re.findall) of this provider for this msg."""
+        """Return all matches (as from re.findall) of this provider for this msg,
+           as (position, match) tuples."""
         if self.re is None: return []
 
-        return re.findall(self.re, msg)
+        return _findall(self.re, msg)
 
     def addChannel(self, channel, regex=None, default=False):
         """Adds a dedicated trigger regex for this provider for a channel.
@@ -146,20 +476,42 @@ class BaseProvider(object):
             log.warning("[%s] re-adding %s"%(self.name, channel))
         self.channels[channel] = { 're': regex, 'default': default }
 
+    def _definition(self, provider):
+        """Return a comparable representation of how provider was configured
+           according to our configAttributes, or None if some attribute
+           cannot be compared."""
+        try:
+            return (type(provider).__qualname__,
+                    tuple(_comparable(getattr(provider, attr, None)) for attr in self.configAttributes))
+        except _Incomparable:
+            return None
+
+    def adoptState(self, old):
+        """Take over the runtime state of old, the provider of the same name
+           from a previous config, if it was defined the same way.
+
+           Returns True if the state was taken over, False if this provider
+           differs from old (or we cannot tell) and starts afresh."""
+        mine = self._definition(self)
+        if mine is None or mine != self._definition(old):
+            return False
+        for attr in self.stateAttributes:
+            if hasattr(old, attr):
+                setattr(self, attr, getattr(old, attr))
+        return True
+
     def _do_log(self, tgt):
         for d in self.debugChannels:
             if fnmatch.fnmatch(tgt, d):
                 return True
         return False
 
-    def doPrivmsg(self, tgt, msg):
-        """Handle msg for channel/target tgt.
+    def findMatches(self, tgt, msg):
+        """Return the distinct matches in msg for channel/target tgt, as
+        (position, match) tuples in order of their first mention.
 
         This collects all the matches from the default_re and any channel
         specific matches (default or channel specific regex).
-
-        Then it goes through all the matches, collects the information and
-        sends it to the target.
         """
 
         if self._do_log(tgt): log.debug("[%s][%s] in doPrivmsg %s"%(self.name, tgt, msg))
@@ -172,30 +524,314 @@ class BaseProvider(object):
 
                 if ch['default']:
                     if self._do_log(tgt): log.debug("[%s][%s] checking default regex for %s: %s %s"%(self.name, tgt, key, self.defaultRE, msg))
-                    matches += re.findall(self.defaultRE, msg)
+                    matches += _findall(self.defaultRE, msg)
                 if ch['re'] is not None:
                     if self._do_log(tgt): log.debug("[%s][%s] checking extra regex for %s: %s %s"%(self.name, tgt, key, ch['re'], msg))
-                    matches += re.findall(ch['re'], msg)
+                    matches += _findall(ch['re'], msg)
+
+        # Several channel patterns (say '#deb*' and '#debian-*') can
+        # match the same ticket.
+        first = {}
+        for (pos, m) in sorted(matches, key=lambda pm: pm[0]):
+            first.setdefault(m, pos)
+        matches = [(pos, m) for (m, pos) in first.items()]
 
         if self._do_log(tgt): log.debug("[%s] matches: %s"%(self.name, matches))
         if len(matches) >= 4:
-            log.debug("[%s] skipping because too many matches (%d)"%(len(matches),))
-            return
-        for m in matches:
-            if (tgt,m) in self.lastSent and \
-                self.lastSent[(tgt,m)] >= time.time() - self.minRepeat:
-                log.debug("[%s][%s] rate limited match %s"%(self.name, tgt, m))
-                continue
+            log.debug("[%s] skipping because too many matches (%d)"%(self.name, len(matches)))
+            return []
+        return matches
+
+    def ticketId(self, m):
+        """Return the canonical identity of the ticket match m refers to.
+
+        Providers with the same identity namespace refer to the same tickets
+        with the same match, so only one of them needs to look it up."""
+        return (self.identity, m)
+
+    def isRateLimited(self, tgt, m):
+        """Whether this provider sent ticket m to tgt recently."""
+        if (tgt, m) in self.lastSent and \
+            self.lastSent[(tgt, m)] >= time.time() - self.minRepeat:
+            log.debug("[%s][%s] rate limited match %s"%(self.name, tgt, m))
+            return True
+        return False
+
+    def lookup(self, tgt, m):
+        """Collect the information for match m and return the line to send
+           to tgt, or None if the lookup failed."""
+        try:
+            item = self[m]
+        except IndexError:
+            log.debug("[%s][%s] failed to lookup %s"%(self.name, tgt, m))
+            return None
+
+        if self._do_log(tgt): log.debug("[%s][%s] sending for %s: %s"%(self.name, tgt, m, item))
+        self.lastSent[(tgt,m)] = time.time()
+        return item
+
+def collectPending(providers, tgt, msg):
+    """Collect the lookups needed for msg in channel/target tgt.
+
+    Every distinct ticket mentioned in msg is looked up once, by the
+    provider with the highest precedence among those matching it, unless
+    it was sent to tgt recently by any provider with the same identity.
+
+    :param providers The providers to consider.
+    :returns A list of (provider, match) tuples, in order of mention.
+    """
+    providers = list(providers)
+    byIdentity = collections.defaultdict(list)
+    for provider in providers:
+        byIdentity[provider.identity].append(provider)
+
+    candidates = {}     # ticketId -> (position, provider, match)
+    for provider in providers:
+        # A broken provider (say, a bad regex) must not silence the others.
+        try:
+            matches = provider.findMatches(tgt, msg)
+        except Exception:
+            log.exception("[%s][%s] failed to find matches"%(provider.name, tgt))
+            continue
+        for (pos, m) in matches:
+            key = provider.ticketId(m)
+            if key in candidates:
+                (otherPos, other, otherMatch) = candidates[key]
+                pos = min(pos, otherPos)
+                if other.precedence >= provider.precedence:
+                    log.debug("[%s][%s] %s is left to %s"%(provider.name, tgt, m, other.name))
+                    candidates[key] = (pos, other, otherMatch)
+                    continue
+            candidates[key] = (pos, provider, m)
+    pending = sorted(candidates.values(), key=lambda c: c[0])
+    return [(provider, m) for (_, provider, m) in pending
+            if not any(alias.isRateLimited(tgt, m) for alias in byIdentity[provider.identity])]
+
+def adoptState(providers, previous):
+    """Carry over runtime state (rate limits, caches) from the providers of
+    a previous config to those defined the same way in a new one.
+
+    :param providers The providers of the new config, by name.
+    :param previous The providers of the config it replaces, by name.
+    :returns A tuple of the names of the providers that kept their state,
+             and of those that were rebuilt.
+    """
+    kept = []
+    rebuilt = []
+    for name, provider in providers.items():
+        old = previous.get(name)
+        if old is not None and provider.adoptState(old):
+            kept.append(name)
+        else:
+            rebuilt.append(name)
+    return (kept, rebuilt)
+
+class LoadShedder(object):
+    """Limits the number of ticket lookups done per channel and overall.
+
+    A paste full of ticket references or a backlog replay should neither
+    keep the bot busy nor starve other channels.  Lookups are admitted
+    while fewer than perChannel lookups were done for the channel, and
+    fewer than overall lookups in total, during the last window seconds.
+    Everything else is shed, matches of the lowest priority providers
+    first.
+
+    A channel that asks for more than burst lookups during the window,
+    far more than its share in normal conversation, is considered flooded
+    and gets no lookups at all for the next suppress seconds.
+    """
 
+    def __init__(self, window=60, perChannel=8, overall=30, burst=24, suppress=300):
+        self.window = window
+        self.perChannel = perChannel
+        self.overall = overall
+        self.burst = burst
+        self.suppress = suppress
+
+        self.recent = collections.deque()       # (timestamp, channel) of admitted lookups
+        self.requested = collections.deque()    # (timestamp, channel, count) of lookups asked for
+        self.suppressed = {}                    # channel -> timestamp suppression ends
+        self.shed = collections.Counter()       # (channel, provider name) -> lookups shed
+
+    def adoptState(self, old):
+        """Take over the runtime state of old, the shedder of a previous instance."""
+        self.recent = old.recent
+        self.requested = old.requested
+        self.suppressed = old.suppressed
+        self.shed = old.shed
+
+    def _expire(self, now):
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+        while self.requested and self.requested[0][0] < now - self.window:
+            self.requested.popleft()
+        for channel in [c for c, until in self.suppressed.items() if until <= now]:
+            del self.suppressed[channel]
+
+    def _shed(self, tgt, pending):
+        for provider, m in pending:
+            self.shed[(tgt, provider.name)] += 1
+
+    def admit(self, tgt, pending):
+        """Decide which lookups for channel/target tgt to do.
+
+        :param pending A list of (provider, match) tuples.
+        :returns The admitted (provider, match) tuples, in the order given.
+        """
+        if not pending:
+            return []
+
+        now = time.time()
+        self._expire(now)
+
+        if tgt in self.suppressed:
+            log.debug("[%s] shedding %d lookups, channel is flooded"%(tgt, len(pending)))
+            self._shed(tgt, pending)
+            return []
+
+        inChannel = sum(1 for (_, channel) in self.recent if channel == tgt)
+        budget = max(0, min(self.perChannel - inChannel, self.overall - len(self.recent)))
+        # Keep the budget's worth of highest priority lookups (earlier
+        # mentions win ties), but do them in the order they came in.
+        ranked = sorted(range(len(pending)), key=lambda i: -pending[i][0].priority)
+        keep = set(ranked[:budget])
+        admitted = [pm for (i, pm) in enumerate(pending) if i in keep]
+        dropped = [pm for (i, pm) in enumerate(pending) if i not in keep]
+
+        if dropped:
+            log.debug("[%s] shedding %d lookups"%(tgt, len(dropped)))
+            self._shed(tgt, dropped)
+
+        self.requested.append((now, tgt, len(pending)))
+        requested = sum(n for (_, channel, n) in self.requested if channel == tgt)
+        if requested > self.burst:
+            log.info("[%s] suppressing lookups for %d seconds, channel is flooded"%(tgt, self.suppress))
+            self.suppressed[tgt] = now + self.suppress
+
+        for _ in admitted:
+            self.recent.append((now, tgt))
+        return admitted
+
+class ProfileSession(object):
+    """Profiles the handling of channel messages, split up by provider.
+
+    While the session runs, findMatches() and lookup() of every provider
+    are replaced by wrappers that run them under the provider's own
+    cProfile.Profile.  Whatever else the plugin does for a message runs
+    under the session's own profile, by way of call().  stop() removes the
+    wrappers again, so providers pay nothing when no session runs.
+    """
+    wrapped = ('findMatches', 'lookup')
+    pluginName = 'Ticket.doPrivmsg'
+
+    def __init__(self, providers, messages=None, seconds=None):
+        """
+        :param messages Stop after this many messages were handled.
+        :param seconds Stop after this many seconds.
+        """
+        self.providers = list(providers)
+        self.messagesLeft = messages
+        self.deadline = time.time() + seconds if seconds is not None else None
+        self.messages = 0
+        self.written = False
+        self.profiles = { self.pluginName: cProfile.Profile() }    # name -> cProfile.Profile
+        self.elapsed = collections.Counter()    # name -> seconds spent, not counting nested profiles
+        self.lookups = collections.Counter()    # provider name -> lookups done
+        self.running = []                       # names of the profiles entered, innermost last
+        self.resumed = None                     # when the innermost one was last resumed
+
+        for provider in self.providers:
+            self.profiles[provider.name] = cProfile.Profile()
+            for method in self.wrapped:
+                setattr(provider, method, self._wrap(provider.name, method, getattr(provider, method)))
+
+    # Only one profile may be active at a time, so entering a nested one
+    # pauses the outer one until the nested one is left.
+    def _pause(self, now):
+        name = self.running[-1]
+        self.profiles[name].disable()
+        self.elapsed[name] += now - self.resumed
+
+    def _resume(self, now):
+        self.resumed = now
+        self.profiles[self.running[-1]].enable()
+
+    def _enter(self, name):
+        now = time.perf_counter()
+        if self.running: self._pause(now)
+        self.running.append(name)
+        self._resume(now)
+
+    def _leave(self):
+        now = time.perf_counter()
+        self._pause(now)
+        self.running.pop()
+        if self.running: self._resume(now)
+
+    def _wrap(self, name, method, func):
+        def wrapper(*args, **kwargs):
+            if method == 'lookup': self.lookups[name] += 1
+            self._enter(name)
             try:
-                item = self[m]
-            except IndexError:
-                log.debug("[%s][%s] failed to lookup %s"%(self.name, tgt, m))
-                continue
+                return func(*args, **kwargs)
+            finally:
+                self._leave()
+        return wrapper
+
+    def call(self, func, *args, **kwargs):
+        """Run func under the session's own profile."""
+        self._enter(self.pluginName)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._leave()
 
-            if self._do_log(tgt): log.debug("[%s][%s] sending for %s: %s"%(self.name, tgt, m, item))
-            self.lastSent[(tgt,m)] = time.time()
-            yield item
+    def countMessage(self):
+        self.messages += 1
+        if self.messagesLeft is not None: self.messagesLeft -= 1
+
+    def isDone(self):
+        if self.messagesLeft is not None and self.messagesLeft <= 0: return True
+        if self.deadline is not None and time.time() >= self.deadline: return True
+        return False
+
+    def stop(self, path=None):
+        """Remove the wrappers and, if path is given, write all the
+           collected profiles combined to path in pstats format.
+
+           Sets and returns written, whether a profile was written."""
+        for provider in self.providers:
+            for method in self.wrapped:
+                provider.__dict__.pop(method, None)
+
+        profiles = [self.profiles[name] for name in self.elapsed]
+        self.written = path is not None and len(profiles) > 0
+        if self.written:
+            pstats.Stats(*profiles).dump_stats(path)
+        return self.written
+
+    def summary(self, top=5, functions=3):
+        """Return a line for the plugin itself and each provider that did a
+           lookup, at most top lines, busiest first.  Each lists its hottest
+           functions by own time."""
+        names = [name for (name, elapsed) in self.elapsed.most_common()
+                 if name == self.pluginName or self.lookups[name] > 0][:top]
+        lines = []
+        for name in names:
+            stats = pstats.Stats(self.profiles[name]).stats
+            hot = sorted(((tt, func) for (func, (cc, nc, tt, ct, callers)) in stats.items()
+                          if '_lsprof.Profiler' not in func[2]), reverse=True)[:functions]
+            funcs = []
+            for (tt, (filename, lineno, funcname)) in hot:
+                if filename != '~':
+                    funcname = '%s:%d(%s)'%(os.path.basename(filename), lineno, funcname)
+                funcs.append('%s %.2fms'%(funcname, tt * 1000))
+            if name == self.pluginName:
+                what = '%s: %.2fms'%(name, self.elapsed[name] * 1000)
+            else:
+                what = '%s: %.2fms in %d lookups'%(name, self.elapsed[name] * 1000, self.lookups[name])
+            lines.append('%s; %s'%(what, ', '.join(funcs)))
+        return lines
 
 def TracStatusExtractor(provider, ticketnumber, extra):
     """Extracts the status of a trac ticket from the bugnumber and soup (as returned by gettitle)
@@ -234,6 +870,7 @@ def GitLabStatusExtractor(provider, ticketnumber, extra):
 class TicketHtmlTitleProvider(BaseProvider):
     """A ticket information provider that extracts the title
        tag from html pages at $url$ticketnumber."""
+    configAttributes = BaseProvider.configAttributes + ('url',)
 
     def __init__(self, name, url, *args, **kwargs):
         """Constructs a ticket html title provider.
@@ -247,14 +884,11 @@ class TicketHtmlTitleProvider(BaseProvider):
     def _gettitle(self, ticketnumber, url=None):
         """Get the html title from the url given in the class or overridden on call."""
         try:
-            response = urllib.request.urlopen('%s%s'%(url or self.url, ticketnumber))
+            response = self.transport.fetch('%s%s'%(url or self.url, ticketnumber), self.maxResponseSize)
         except urllib.error.HTTPError as e:
             raise IndexError(e)
 
-        data = response.read()
-
-        charset = response.info().get_content_charset()
-        if charset: data = data.decode(charset)
+        data = response.text()
 
         soup = BeautifulSoup(data, 'html.parser')
         title = soup.title.string
@@ -302,28 +936,28 @@ class GitlabTitleProvider(TicketHtmlTitleProvider):
 
 class TorProposalProvider(BaseProvider):
     """Get information on tor proposals from gitweb.torproject.org"""
+    stateAttributes = BaseProvider.stateAttributes + ('expire', 'data')
+    configAttributes = BaseProvider.configAttributes + ('url',)
 
     def __init__(self, name, *args, **kwargs):
         BaseProvider.__init__(self, name, *args, **kwargs)
 
         self.url = 'https://gitweb.torproject.org/torspec.git/tree/proposals/000-index.txt'
 
+        # The index is fetched on first use (or taken over from a previous
+        # config by adoptState()), not when the config is built.
         self.expire = 0
         self.data = None
-        self.update()
 
     def update(self):
         if self.expire > time.time(): return
 
         try:
-            response = urllib.request.urlopen(self.url)
+            response = self.transport.fetch(self.url, self.maxResponseSize)
         except:
             return
 
-        data = response.read()
-
-        charset = response.info().get_content_charset()
-        if charset: data = data.decode(charset)
+        data = response.text()
 
         self.data = data
         self.expire = time.time() + 7200
@@ -345,6 +979,7 @@ class TorProposalProvider(BaseProvider):
 class TicketRTProvider(BaseProvider):
     """A ticket information provider that returns the title
        of a request-tracker ticket."""
+    configAttributes = BaseProvider.configAttributes + ('rtrc',)
     def __init__(self, name, rtconfigpath, *args, **kwargs):
         """Constructs a RT title provider.
 
@@ -361,7 +996,7 @@ class TicketRTProvider(BaseProvider):
     def _gettitle(self, ticketnumber):
         ticketnumber = int(ticketnumber)
         try:
-            rtclientouput = subprocess.check_output(['rt', 'ls', '-i', str(ticketnumber), '-s'], env={ 'RTCONFIG': self.rtrc } )
+            rtclientouput = self.transport.run(['rt', 'ls', '-i', str(ticketnumber), '-s'], { 'RTCONFIG': self.rtrc })
         except subprocess.CalledProcessError as e:
             raise IndexError(e)
 
@@ -383,6 +1018,9 @@ class ReGroupFixup:
     def __init__(self, groupre):
         self.groupre = groupre
 
+    def definition(self):
+        return self.groupre
+
     def __call__(self, i, x, extra=None):
         m = re.match(self.groupre, x)
         if m and len(m.groups()) > 0: x = m.group(1)